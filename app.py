@@ -1,10 +1,29 @@
-import os, time, hmac, hashlib, math
+import asyncio, os, ssl, time, hmac, hashlib, urllib.parse
+from collections import defaultdict
+from dataclasses import dataclass, field
+from decimal import Decimal, ROUND_DOWN
 from typing import Dict, Any
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse
 import httpx
+import orjson
+import websockets
+from cachetools import TTLCache
+
+# Install uvloop before any client/loop objects are created so they bind to
+# its transports. Run single-worker to keep the in-memory caches and ws
+# sessions authoritative:
+#   uvicorn app:app --loop uvloop --http httptools --workers 1
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 # ===== ENV =====
 BINANCE_BASE = os.getenv("BINANCE_BASE", "https://api.binance.us")
+BINANCE_WS_STREAM = os.getenv("BINANCE_WS_STREAM", "wss://stream.binance.us:9443")
+BINANCE_WS_API = os.getenv("BINANCE_WS_API", "wss://ws-api.binance.us:443/ws-api/v3")
 API_KEY      = os.getenv("BINANCE_API_KEY", "")
 API_SECRET   = os.getenv("BINANCE_API_SECRET", "")
 TV_PASSPHRASE= os.getenv("TV_PASSPHRASE", "")
@@ -13,125 +32,450 @@ MAX_POSITIONS = int(os.getenv("MAX_CONCURRENT_POSITIONS", "1"))
 TP_PCT = float(os.getenv("TP_PCT", "15"))
 SL_PCT = float(os.getenv("SL_PCT", "6"))
 
-SYMBOLS = ["SOLUSDT", "JUPUSDT", "BONKUSDT"]
+def _base_asset(symbol: str) -> str:
+    for q in ("USDT", "BUSD", "USDC", "USD"):
+        if symbol.endswith(q):
+            return symbol[:-len(q)]
+    return symbol
 
-app = FastAPI()
+# One module serves any symbol/quote set; bases and the TradingView event
+# table are derived from SYMBOLS instead of being hardcoded per deployment.
+SYMBOLS = [s.strip() for s in os.getenv("SYMBOLS", "SOLUSDT,JUPUSDT,BONKUSDT").split(",") if s.strip()]
+_MANAGED_BASES = frozenset(_base_asset(s) for s in SYMBOLS)
+_EVENT_MAP = {f"LONG_{_base_asset(s)}": s for s in SYMBOLS}
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# One long-lived client: keep-alive + HTTP/2 avoid a TCP+TLS handshake per call.
+HTTPX_CLIENT = httpx.AsyncClient(
+    base_url=BINANCE_BASE,
+    timeout=20,
+    limits=httpx.Limits(max_keepalive_connections=8, max_connections=16),
+    http2=True,
+)
+
+@app.on_event("shutdown")
+async def _close_client():
+    await HTTPX_CLIENT.aclose()
 
 @app.get("/health")
 async def health():
     return {"ok": True}
 
+# exchangeInfo is a multi-MB download; cache (lot_step, tick_size, min_notional)
+# per symbol, preloaded at startup and refreshed on a coarse TTL.
+EXINFO_CACHE: Dict[str, Any] = {}
+EXINFO_EXPIRY: float = 0.0
+EXINFO_TTL = 3600
+
+def _parse_filters(sym_info) -> Dict[str, float]:
+    # lot_dec/tick_dec are cached quantize exponents for _step_floor/_round_to_tick.
+    out = {"lot_dec": Decimal("0.0001"), "tick_dec": Decimal("0.0001"), "min_notional": 0.0}
+    for f in sym_info["filters"]:
+        if f["filterType"] == "LOT_SIZE":
+            out["lot_dec"] = Decimal(f["stepSize"]).normalize()
+        elif f["filterType"] == "PRICE_FILTER":
+            out["tick_dec"] = Decimal(f["tickSize"]).normalize()
+        elif f["filterType"] in ("MIN_NOTIONAL", "NOTIONAL"):
+            out["min_notional"] = float(f.get("minNotional", 0))
+    return out
+
+async def _load_exchange_info():
+    global EXINFO_EXPIRY
+    info = await _req("GET", "/api/v3/exchangeInfo")
+    for s in info["symbols"]:
+        if s["symbol"] in SYMBOLS:
+            EXINFO_CACHE[s["symbol"]] = _parse_filters(s)
+    EXINFO_EXPIRY = time.time() + EXINFO_TTL
+
+@app.on_event("startup")
+async def _log_crypto_backend():
+    # Signing relies on OpenSSL's SHA-256 (hardware SHA-NI/ARMv8 dispatch on
+    # OpenSSL >= 1.1.1); surface the linked version so a slow build is visible.
+    assert "sha256" in hashlib.algorithms_available
+    print(f"OpenSSL: {ssl.OPENSSL_VERSION}")
+
+@app.on_event("startup")
+async def _warm_exchange_info():
+    # Warm-up only — if Binance is unreachable at boot, get_symbol_filters
+    # loads lazily on first use rather than failing startup.
+    try:
+        await _load_exchange_info()
+    except Exception:
+        pass
+
+async def get_symbol_filters(symbol):
+    if symbol not in EXINFO_CACHE or time.time() >= EXINFO_EXPIRY:
+        await _load_exchange_info()
+    return EXINFO_CACHE[symbol]
+
 # ===== Helpers =====
 
-def _ts() -> str:
-    return str(int(time.time() * 1000))
+_TS_LAST = (0, "0")
 
-def _sign(params: Dict[str, Any]) -> str:
-    query = "&".join([f"{k}={params[k]}" for k in sorted(params.keys())])
-    return hmac.new(API_SECRET.encode(), query.encode(), hashlib.sha256).hexdigest()
+def _ts() -> str:
+    # Integer path (no float multiply/truncate); reuse the formatted string
+    # when several signs land in the same millisecond.
+    global _TS_LAST
+    ms = time.time_ns() // 1_000_000
+    if ms != _TS_LAST[0]:
+        _TS_LAST = (ms, str(ms))
+    return _TS_LAST[1]
+
+def _step_floor(n: float, step: Decimal) -> str:
+    # Quantize against the cached step exponent; exact by construction,
+    # unlike float division which can land one lot below the intended qty.
+    # format(..., "f") because str() switches to exponent notation below
+    # 1e-6, which Binance rejects in quantity/price fields.
+    return format(Decimal(str(n)).quantize(step, rounding=ROUND_DOWN), "f")
+
+def _round_to_tick(price: float, tick: Decimal) -> str:
+    return format(Decimal(str(price)).quantize(tick, rounding=ROUND_DOWN), "f")
+
+# Prime the HMAC once so each signature only pays for copy+update,
+# not the per-call key-derivation step in hmac.new().
+_API_SECRET_BYTES = API_SECRET.encode()
+_HMAC_TEMPLATE = hmac.new(_API_SECRET_BYTES, b"", hashlib.sha256)
+
+def _sign_str(query: str) -> str:
+    h = _HMAC_TEMPLATE.copy()
+    h.update(query.encode("ascii"))
+    return h.hexdigest()
+
+# The hot signed endpoints have a fixed schema; only quantity/prices and
+# the timestamp vary at runtime, so the static part of each query is
+# preserialized per symbol and variable fields are appended before signing.
+_MARKET_BUY_TEMPLATE = {s: f"side=BUY&symbol={s}&type=MARKET" for s in SYMBOLS}
+_OCO_TEMPLATE = {s: f"side=SELL&stopLimitTimeInForce=GTC&symbol={s}&type=OCO" for s in SYMBOLS}
+
+async def _req_signed_qs(method: str, path: str, qs: str):
+    """Send a prebuilt query string, signed as-is."""
+    r = await HTTPX_CLIENT.request(method, f"{path}?{qs}&signature={_sign_str(qs)}",
+                                   headers={"X-MBX-APIKEY": API_KEY})
+    if r.status_code >= 400:
+        raise HTTPException(r.status_code, r.text)
+    return orjson.loads(r.content)
 
-async def _req(method: str, path: str, signed=False, params=None):
-    url = f"{BINANCE_BASE}{path}"
+async def _req(method: str, path: str, signed=False, params=None, keyed=False):
     params = params or {}
     headers = {}
 
+    if keyed:
+        # Endpoints like userDataStream want the API key header but no signature.
+        headers["X-MBX-APIKEY"] = API_KEY
+
     if signed:
-        params["recvWindow"] = 5000
+        # Serialize once and sign the exact bytes sent, so httpx never
+        # re-encodes the params into something the signature doesn't cover.
         params["timestamp"] = _ts()
-        params["signature"] = _sign(params)
+        params["recvWindow"] = 5000
+        qs = urllib.parse.urlencode(sorted(params.items()), doseq=True)
+        path = f"{path}?{qs}&signature={_sign_str(qs)}"
+        params = None
         headers["X-MBX-APIKEY"] = API_KEY
 
-    async with httpx.AsyncClient(timeout=20) as c:
-        r = await c.request(method, url, params=params, headers=headers)
+    r = await HTTPX_CLIENT.request(method, path, params=params, headers=headers)
 
     if r.status_code >= 400:
         raise HTTPException(r.status_code, r.text)
 
-    return r.json()
+    return orjson.loads(r.content)
 
 # ===== Account =====
 
 async def get_account():
     return await _req("GET", "/api/v3/account", signed=True)
 
-async def has_any_position():
+_STABLES = frozenset(("USD", "USDT", "BUSD", "USDC"))
+
+def _scan_balances(bals):
+    # One pass over the ~300-asset balance list: spendable stables for
+    # sizing, plus whether any managed base is already held.
+    usd = 0.0
+    pos = False
+    for a, free, locked in bals:
+        if a in _STABLES:
+            usd += free
+        elif a in _MANAGED_BASES and free + locked > 0.0001:
+            pos = True
+    return usd, pos
+
+# ===== Websocket snapshot =====
+# Balances and best-bid/ask arrive as push streams; webhooks read the
+# in-memory snapshot instead of REST-polling account and ticker. Single
+# writer (the ws tasks), many readers, all on one event loop — no lock needed.
+
+@dataclass
+class Snapshot:
+    prices: Dict[str, float] = field(default_factory=dict)
+    balances: Dict[str, tuple] = field(default_factory=dict)  # asset -> (free, locked)
+    account_ready: bool = False
+
+SNAPSHOT = Snapshot()
+_WS_TASKS = []
+
+async def _book_ticker_ws():
+    streams = "/".join(f"{s.lower()}@bookTicker" for s in SYMBOLS)
+    url = f"{BINANCE_WS_STREAM}/stream?streams={streams}"
+    while True:
+        try:
+            async with websockets.connect(url, ping_interval=60) as ws:
+                async for raw in ws:
+                    d = orjson.loads(raw).get("data")
+                    if d:
+                        SNAPSHOT.prices[d["s"]] = (float(d["b"]) + float(d["a"])) / 2
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"bookTicker stream error, reconnecting: {e!r}")
+        finally:
+            # Entries would go arbitrarily stale while reconnecting; clearing
+            # makes get_price fall through to the REST+TTL path.
+            SNAPSHOT.prices.clear()
+        await asyncio.sleep(2)
+
+async def _keepalive_listen_key(listen_key):
+    while True:
+        await asyncio.sleep(1800)
+        try:
+            await _req("PUT", "/api/v3/userDataStream", keyed=True,
+                       params={"listenKey": listen_key})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # One failed PUT must not end keepalives for a healthy stream;
+            # the key survives ~60 min, so the next cycle can still renew it.
+            print(f"listenKey keepalive failed: {e!r}")
+
+async def _user_data_ws():
+    while True:
+        keepalive = None
+        try:
+            lk = (await _req("POST", "/api/v3/userDataStream", keyed=True))["listenKey"]
+            keepalive = asyncio.create_task(_keepalive_listen_key(lk))
+            async with websockets.connect(f"{BINANCE_WS_STREAM}/ws/{lk}") as ws:
+                # Reseed over REST on every (re)connect — events missed while
+                # disconnected are lost, so the old map can't be trusted.
+                # Seeding after the stream is open means a fill in between
+                # still arrives as a queued ws event and lands on top.
+                acct = await get_account()
+                SNAPSHOT.balances = {b["asset"]: (float(b["free"]), float(b["locked"]))
+                                     for b in acct["balances"]}
+                SNAPSHOT.account_ready = True
+                async for raw in ws:
+                    ev = orjson.loads(raw)
+                    if ev.get("e") == "outboundAccountPosition":
+                        for b in ev["B"]:
+                            SNAPSHOT.balances[b["a"]] = (float(b["f"]), float(b["l"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"user-data stream error, reconnecting: {e!r}")
+        finally:
+            # While disconnected the snapshot may miss fills; send readers
+            # back to REST until the next reseed.
+            SNAPSHOT.account_ready = False
+            if keepalive:
+                keepalive.cancel()
+        await asyncio.sleep(2)
+
+@app.on_event("startup")
+async def _start_ws_feeds():
+    _WS_TASKS.append(asyncio.create_task(_book_ticker_ws()))
+    _WS_TASKS.append(asyncio.create_task(_user_data_ws()))
+    _WS_TASKS.append(asyncio.create_task(_ws_api_task()))
+
+@app.on_event("shutdown")
+async def _stop_ws_feeds():
+    for t in _WS_TASKS:
+        t.cancel()
+
+async def get_balances():
+    """(asset, free, locked) tuples — from the snapshot when warm, else REST."""
+    if SNAPSHOT.account_ready:
+        return [(a, fl[0], fl[1]) for a, fl in SNAPSHOT.balances.items()]
     acct = await get_account()
-    bal = {b["asset"]: float(b["free"]) + float(b["locked"]) for b in acct["balances"]}
-    bases = {"SOLUSDT": "SOL", "JUPUSDT": "JUP", "BONKUSDT": "BONK"}
-    return any(bal.get(base, 0) > 0.0001 for base in bases.values())
+    return [(b["asset"], float(b["free"]), float(b["locked"])) for b in acct["balances"]]
+
+# Bursty alerts for one symbol within a second share a single ticker fetch.
+_PRICE_CACHE = TTLCache(maxsize=32, ttl=1.0)
 
 async def get_price(symbol):
-    r = await _req("GET", "/api/v3/ticker/price", params={"symbol": symbol})
-    return float(r["price"])
+    price = SNAPSHOT.prices.get(symbol)
+    if price is not None:
+        return price
+    price = _PRICE_CACHE.get(symbol)
+    if price is None:
+        r = await _req("GET", "/api/v3/ticker/price", params={"symbol": symbol})
+        price = _PRICE_CACHE[symbol] = float(r["price"])
+    return price
 
 # ===== Orders =====
+# Orders go over one persistent ws-api session (request/response correlated
+# by id) — no HTTP framing per call. REST remains the fallback while the
+# session is down.
+
+_WSAPI_CONN = None
+_WSAPI_PENDING: Dict[int, asyncio.Future] = {}
+_WSAPI_NEXT_ID = 0
+
+async def _ws_api_task():
+    global _WSAPI_CONN
+    while True:
+        try:
+            async with websockets.connect(BINANCE_WS_API, ping_interval=60) as ws:
+                _WSAPI_CONN = ws
+                async for raw in ws:
+                    msg = orjson.loads(raw)
+                    fut = _WSAPI_PENDING.pop(msg.get("id"), None)
+                    if fut and not fut.done():
+                        fut.set_result(msg)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"ws-api session error, reconnecting: {e!r}")
+        finally:
+            _WSAPI_CONN = None
+            for fut in _WSAPI_PENDING.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError("ws-api session dropped"))
+            _WSAPI_PENDING.clear()
+        await asyncio.sleep(2)
+
+async def _ws_api_request(method: str, params: Dict[str, Any]):
+    global _WSAPI_NEXT_ID
+    ws = _WSAPI_CONN
+    params["apiKey"] = API_KEY
+    # ws-api JSON is type-checked, unlike REST query strings: timestamp and
+    # recvWindow must go out as integers.
+    params["timestamp"] = time.time_ns() // 1_000_000
+    params["recvWindow"] = 5000
+    qs = "&".join([f"{k}={params[k]}" for k in sorted(params.keys())])
+    params["signature"] = _sign_str(qs)
+    _WSAPI_NEXT_ID += 1
+    rid = _WSAPI_NEXT_ID
+    fut = asyncio.get_running_loop().create_future()
+    _WSAPI_PENDING[rid] = fut
+    await ws.send(orjson.dumps({"id": rid, "method": method, "params": params}).decode())
+    msg = await asyncio.wait_for(fut, timeout=10)
+    if msg.get("status") != 200:
+        raise HTTPException(msg.get("status", 500), str(msg.get("error")))
+    return msg["result"]
 
 async def market_buy(symbol, qty):
-    return await _req("POST", "/api/v3/order", signed=True, params={
-        "symbol": symbol,
-        "side": "BUY",
-        "type": "MARKET",
-        "quantity": qty
-    })
+    if _WSAPI_CONN is not None:
+        return await _ws_api_request("order.place", {
+            "symbol": symbol, "side": "BUY", "type": "MARKET", "quantity": qty})
+    qs = f"{_MARKET_BUY_TEMPLATE[symbol]}&quantity={qty}&recvWindow=5000&timestamp={_ts()}"
+    return await _req_signed_qs("POST", "/api/v3/order", qs)
 
 async def place_oco(symbol, qty, tp, sl_stop, sl_limit):
-    return await _req("POST", "/api/v3/order/oco", signed=True, params={
-        "symbol": symbol,
-        "side": "SELL",
-        "type": "OCO",
-        "quantity": qty,
-        "price": tp,
-        "stopPrice": sl_stop,
-        "stopLimitPrice": sl_limit,
-        "stopLimitTimeInForce": "GTC"
-    })
+    if _WSAPI_CONN is not None:
+        return await _ws_api_request("orderList.place", {
+            "symbol": symbol, "side": "SELL", "quantity": qty, "price": tp,
+            "stopPrice": sl_stop, "stopLimitPrice": sl_limit,
+            "stopLimitTimeInForce": "GTC"})
+    qs = (f"{_OCO_TEMPLATE[symbol]}&price={tp}&quantity={qty}&stopLimitPrice={sl_limit}"
+          f"&stopPrice={sl_stop}&recvWindow=5000&timestamp={_ts()}")
+    return await _req_signed_qs("POST", "/api/v3/order/oco", qs)
+
+async def cancel_oco(symbol, order_list_id):
+    params = {"symbol": symbol, "orderListId": order_list_id}
+    if _WSAPI_CONN is not None:
+        return await _ws_api_request("orderList.cancel", params)
+    return await _req("DELETE", "/api/v3/orderList", signed=True, params=params)
 
 # ===== Main Logic =====
 
+# Racing alerts must not both pass the position check before either buy
+# lands; the global lock makes check-then-buy atomic across symbols.
+_SYMBOL_LOCKS: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+_GLOBAL_POS_LOCK = asyncio.Lock()
+
 async def enter_trade(symbol, pct):
-    if MAX_POSITIONS == 1 and await has_any_position():
+    async with _SYMBOL_LOCKS[symbol], _GLOBAL_POS_LOCK:
+        return await _enter_trade_locked(symbol, pct)
+
+async def _enter_trade_locked(symbol, pct):
+    # Account, filters and price are independent: fetch them concurrently
+    # and reuse the one balance snapshot for both the position check and sizing.
+    bals, filters, price = await asyncio.gather(
+        get_balances(), get_symbol_filters(symbol), get_price(symbol)
+    )
+
+    usd, has_pos = _scan_balances(bals)
+    if MAX_POSITIONS == 1 and has_pos:
         return {"ok": False, "msg": "Position already open. Skipping."}
 
-    price = await get_price(symbol)
-
-    acct = await get_account()
-    usd = sum(float(b["free"]) for b in acct["balances"] if b["asset"] in ("USDT", "USD", "BUSD"))
     if usd <= 0: usd = 600
 
     notional = usd * (pct / 100.0)
-    qty = round(notional / price, 4)
-    if qty <= 0:
+    qty = _step_floor(notional / price, filters["lot_dec"])
+    if float(qty) <= 0 or float(qty) * price < filters["min_notional"]:
         return {"ok": False, "msg": "Calculated qty too small."}
 
-    buy = await market_buy(symbol, qty)
-
-    tp = round(price * (1 + TP_PCT/100), 4)
-    sl = round(price * (1 - SL_PCT/100), 4)
-    sl_lim = round(sl * 0.999, 4)
-
-    oco = await place_oco(symbol, qty, tp, sl, sl_lim)
+    tick = filters["tick_dec"]
+    tp = _round_to_tick(price * (1 + TP_PCT/100), tick)
+    sl = _round_to_tick(price * (1 - SL_PCT/100), tick)
+    sl_lim = _round_to_tick(float(sl) * 0.999, tick)
+
+    # Fire the buy and the OCO together instead of awaiting the fill first:
+    # halves the window where the position sits without its stop. If the buy
+    # is rejected, the orphan OCO is cancelled; if only the OCO is rejected
+    # (e.g. fee-reduced balance), retry it once sized from the actual free qty.
+    buy, oco = await asyncio.gather(
+        market_buy(symbol, qty),
+        place_oco(symbol, qty, tp, sl, sl_lim),
+        return_exceptions=True,
+    )
+
+    if isinstance(buy, BaseException):
+        if not isinstance(oco, BaseException):
+            await cancel_oco(symbol, oco["orderListId"])
+        raise buy
+
+    # Credit our own fill to the snapshot before the lock is released: the
+    # user-data event confirming it arrives on a separate connection and can
+    # lose the race against an alert already queued on the lock, which would
+    # then pass the position check and open a second position.
+    base = _base_asset(symbol)
+    free, locked = SNAPSHOT.balances.get(base, (0.0, 0.0))
+    SNAPSHOT.balances[base] = (free + float(qty), locked)
+
+    if isinstance(oco, BaseException):
+        acct = await get_account()
+        free = next((float(b["free"]) for b in acct["balances"] if b["asset"] == base), 0.0)
+        qty2 = _step_floor(free, filters["lot_dec"])
+        if float(qty2) <= 0:
+            raise oco
+        oco = await place_oco(symbol, qty2, tp, sl, sl_lim)
+        qty = qty2
 
     return {"ok": True, "symbol": symbol, "qty": qty, "tp": tp, "sl": sl}
 
 # ===== Webhook =====
 
+# TradingView/network retries resend the same alert; remember recent ids
+# briefly so a retry can't open a second position.
+_SEEN_WEBHOOK_IDS = TTLCache(maxsize=1024, ttl=60)
+
 @app.post("/tv")
 async def tradingview(req: Request):
-    body = await req.json()
+    body = orjson.loads(await req.body())
 
     if body.get("passphrase") != TV_PASSPHRASE:
         raise HTTPException(401, "bad passphrase")
 
+    hook_id = body.get("id")
+    if hook_id is not None:
+        if hook_id in _SEEN_WEBHOOK_IDS:
+            return {"ok": False, "msg": "Duplicate webhook. Skipping."}
+        _SEEN_WEBHOOK_IDS[hook_id] = True
+
     event = body.get("event")
     pct = float(body.get("notional_pct", 5))
 
-    mapping = {
-        "LONG_SOL": "SOLUSDT",
-        "LONG_JUP": "JUPUSDT",
-        "LONG_BONK": "BONKUSDT"
-    }
-
-    if event not in mapping:
+    if event not in _EVENT_MAP:
         return {"ok": False, "msg": f"Unknown event {event}"}
 
-    return await enter_trade(mapping[event], pct)
+    return await enter_trade(_EVENT_MAP[event], pct)